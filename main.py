@@ -1,335 +1,428 @@
-import requests
-import json
-import uuid
-import hmac
-import hashlib
-import time
-import os
-import logging
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# 設置日誌，僅輸出到終端（Render.com 會自動收集日誌）
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] %(levelname)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[logging.StreamHandler()]
-)
-logger = logging.getLogger(__name__)
-
-app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "https://magadha.weebly.com"}})
-
-# 使用環境變數儲存敏感資訊
-JKO_PAY_STORE_ID = os.getenv("JKO_PAY_STORE_ID")
-JKO_PAY_API_KEY = os.getenv("JKO_PAY_API_KEY")
-JKO_PAY_SECRET_KEY = os.getenv("JKO_PAY_SECRET_KEY")
-JKO_PAY_ENTRY_URL = os.getenv("JKO_PAY_ENTRY_URL", "https://uat-onlinepay.jkopay.app/platform/entry")
-JKO_PAY_INQUIRY_URL = os.getenv("JKO_PAY_INQUIRY_URL", "https://uat-onlinepay.jkopay.app/platform/inquiry")
-JKO_PAY_REFUND_URL = os.getenv("JKO_PAY_REFUND_URL", "https://uat-onlinepay.jkopay.app/platform/refund")
-BASE_URL = os.getenv("BASE_URL", "https://jkpay.onrender.com")
-GOOGLE_SCRIPT_URL = os.getenv("GOOGLE_SCRIPT_URL", "https://script.google.com/macros/s/AKfycbwju-slnDJ9RYSgWctfjQ7Yg0FOU4Ur6YFu5UWLlKVPsDuMQ3niQI--2b1T06fWBe7PDQ/exec")
-
-# 檢查必要的環境變數是否存在
-required_env_vars = ["JKO_PAY_STORE_ID", "JKO_PAY_API_KEY", "JKO_PAY_SECRET_KEY"]
-for var in required_env_vars:
-    if not os.getenv(var):
-        logger.error(f"缺少必要的環境變數: {var}")
-        raise ValueError(f"缺少必要的環境變數: {var}")
-
-# 使用內存儲存訂單（Render.com 文件系統是臨時的）
-orders = []
-
-def load_orders():
-    return orders
-
-def save_orders(new_orders):
-    global orders
-    orders = new_orders
-
-# 簽名計算函數（與 PHP 一致，不排序，直接使用原始 JSON 字符串）
-def generate_signature(payload, secret_key):
-    # 直接將字典轉為 JSON 字符串，不排序
-    payload_str = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
-    logger.info(f"簽名用的 JSON 字符串: {payload_str}")
-    input_bytes = payload_str.encode("utf-8")
-    secret_key_bytes = secret_key.encode("utf-8")
-    digest = hmac.new(secret_key_bytes, input_bytes, hashlib.sha256).hexdigest()
-    return digest
-
-@app.route("/")
-def home():
-    logger.info("摩揭陀貓舍街口支付伺服器已啟動！（測試環境）")
-    return "摩揭陀貓子街口支付伺服器已啟動！（測試環境）"
-
-@app.route("/generate_payment", methods=["POST"])
-def generate_payment():
-    try:
-        order_data = request.json
-        logger.info(f"收到訂單資料: {order_data}")
-
-        # 根據運送方式動態設置必填字段
-        shipping = order_data.get("shipping")
-        if shipping == "7-11":
-            required_fields = ["totalAmount", "quantity", "name", "email", "phone", "shipping", "payment", "storeInfo", "address"]
-        else:
-            required_fields = ["totalAmount", "quantity", "name", "email", "phone", "shipping", "payment", "city", "district", "address"]
-        missing_fields = [field for field in required_fields if field not in order_data or not order_data[field]]
-        if missing_fields:
-            logger.error(f"缺少必要的字段: {missing_fields}")
-            return jsonify({"error": f"缺少必要的字段: {missing_fields}"}), 400
-
-        total_amount = int(order_data["totalAmount"])
-        quantity = int(order_data["quantity"])
-        payment_method = order_data["payment"]
-
-        # 輸入驗證
-        if total_amount <= 0 or quantity <= 0:
-            logger.error("totalAmount 和 quantity 必須為正整數")
-            return jsonify({"error": "totalAmount 和 quantity 必須為正整數"}), 400
-        if total_amount > 1_000_000:
-            logger.error("totalAmount 超過允許的最大值")
-            return jsonify({"error": "totalAmount 超過允許的最大值"}), 400
-
-        if payment_method != "jkopay":
-            logger.error(f"不支持的付款方式: {payment_method}")
-            return jsonify({"error": f"不支持的付款方式: {payment_method}"}), 400
-
-        # 街口支付邏輯
-        platform_order_id = f"ORDER_{uuid.uuid4()}_{int(time.time())}"
-        data = {
-            "store_id": JKO_PAY_STORE_ID,
-            "platform_order_id": platform_order_id,
-            "currency": "TWD",
-            "total_price": total_amount,
-            "final_price": total_amount,
-            "unredeem": 0,  # 固定為 0，根據街口要求
-            "result_url": f"{BASE_URL}/result_url",
-            "result_display_url": f"{BASE_URL}/result_display_url"
-        }
-
-        # 計算簽名（與 PHP 一致）
-        signature = generate_signature(data, JKO_PAY_SECRET_KEY)
-        logger.info(f"生成的簽名: {signature}")
-        logger.info(f"發送的請求數據: {json.dumps(data, ensure_ascii=False)}")
-        logger.info(f"請求頭: {{'Content-Type': 'application/json; charset=utf-8', 'API-KEY': '{JKO_PAY_API_KEY}', 'DIGEST': '{signature}'}}")
-
-        headers = {
-            "Content-Type": "application/json; charset=utf-8",
-            "API-KEY": JKO_PAY_API_KEY,
-            "DIGEST": signature
-        }
-
-        response = requests.post(JKO_PAY_ENTRY_URL, headers=headers, json=data)
-        logger.info(f"發送街口支付請求 - 狀態碼: {response.status_code}, 回應: {response.text}")
-
-        if response.status_code == 200:
-            try:
-                result = response.json()
-            except ValueError as e:
-                logger.error(f"無法解析街口支付回應: {response.text}")
-                return jsonify({"error": "無法解析街口支付回應"}), 500
-
-            if result.get("result") == "000":
-                payment_url = result["result_object"]["payment_url"]
-                logger.info(f"街口支付連結生成成功，平台訂單ID: {platform_order_id}, 支付URL: {payment_url}")
-
-                # 保存訂單到內存
-                order_to_save = {
-                    **order_data,
-                    "platform_order_id": platform_order_id,
-                    "payment_url": payment_url
-                }
-                orders = load_orders()
-                orders.append(order_to_save)
-                save_orders(orders)
-                logger.info(f"訂單已保存: {order_to_save}")
-
-                return jsonify({"paymentUrl": payment_url})
-            else:
-                logger.error(f"街口支付錯誤: {result}")
-                return jsonify({"error": f"街口支付錯誤: {result.get('message', '未知錯誤')}"}), 500
-        return jsonify({"error": f"無法生成街口支付連結，狀態碼: {response.status_code}"}), 500
-
-    except Exception as e:
-        import traceback
-        logger.error(f"錯誤: {str(e)}")
-        logger.error(f"堆棧跟踪: {traceback.format_exc()}")
-        return jsonify({"error": f"伺服器錯誤: {str(e)}"}), 500
-
-@app.route("/confirm_url", methods=["POST"])
-def confirm_url():
-    try:
-        logger.info("進入 /confirm_url 路由")
-        callback_data = request.json
-        logger.info(f"收到街口支付確認回調: {callback_data}")
-
-        platform_order_id = callback_data.get("platform_order_id")
-        if not platform_order_id:
-            logger.error("無效的確認回調，缺少平台訂單ID")
-            return jsonify({"valid": False}), 400
-
-        # 從內存中查找訂單
-        orders = load_orders()
-        order_data = None
-        for order in orders:
-            if order["platform_order_id"] == platform_order_id:
-                order_data = order
-                logger.info(f"找到匹配的訂單: {order_data}")
-                break
-
-        if not order_data:
-            logger.error(f"找不到對應訂單，平台訂單ID: {platform_order_id}")
-            return jsonify({"valid": False}), 404
-
-        return jsonify({"valid": True})
-
-    except Exception as e:
-        import traceback
-        logger.error(f"確認錯誤: {str(e)}")
-        logger.error(f"堆棧跟踪: {traceback.format_exc()}")
-        return jsonify({"valid": False}), 500
-
-@app.route("/result_url", methods=["POST"])
-def result_url():
-    try:
-        logger.info("進入 /result_url 路由")
-        callback_data = request.json
-        logger.info(f"收到街口支付回調: {callback_data}")
-
-        transaction = callback_data.get("transaction", {})
-        platform_order_id = transaction.get("platform_order_id")
-        status = transaction.get("status")
-        trade_no = transaction.get("tradeNo")
-
-        if not platform_order_id:
-            logger.error("無效的回調，缺少平台訂單ID")
-            return jsonify({"status": "error", "message": "缺少平台訂單ID"}), 400
-
-        # 從內存中查找訂單
-        orders = load_orders()
-        order_data = None
-        for order in orders:
-            if order["platform_order_id"] == platform_order_id:
-                order_data = order
-                logger.info(f"找到匹配的訂單: {order_data}")
-                break
-
-        if not order_data:
-            logger.error(f"找不到對應訂單，平台訂單ID: {platform_order_id}")
-            return jsonify({"status": "error", "message": "訂單未找到"}), 404
-
-        if status == 0:  # 交易成功
-            order_data["paymentMethod"] = "jkopay"
-            order_data["tradeNo"] = trade_no
-            logger.info(f"發送訂單到 Google Apps Script: {order_data}")
-            try:
-                google_response = requests.post(GOOGLE_SCRIPT_URL, data=order_data)
-                logger.info(f"Google Apps Script 回應: {google_response.text}")
-            except Exception as e:
-                logger.error(f"發送訂單到 Google Apps Script 失敗: {str(e)}")
-
-            # 支付成功後，移除已處理的訂單
-            orders = load_orders()
-            orders[:] = [order for order in orders if order["platform_order_id"] != platform_order_id]
-            save_orders(orders)
-
-            return jsonify({"status": "success", "message": "支付確認成功"})
-        else:
-            logger.error(f"街口支付確認失敗，狀態碼: {status}")
-            return jsonify({"status": "error", "message": "支付確認失敗"}), 400
-
-    except Exception as e:
-        import traceback
-        logger.error(f"確認錯誤: {str(e)}")
-        logger.error(f"堆棧跟踪: {traceback.format_exc()}")
-        return jsonify({"status": "error", "message": "伺服器錯誤"}), 500
-
-@app.route("/result_display_url", methods=["GET"])
-def result_display_url():
-    try:
-        logger.info("進入 /result_display_url 路由")
-        platform_order_id = request.args.get("platform_order_id")
-        if not platform_order_id:
-            logger.error("無效的返回，缺少平台訂單ID")
-            return '''
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>無效的返回</title>
-                <style>
-                    body { font-family: Arial, sans-serif; text-align: center; padding: 50px; background-color: #f9fafb; }
-                    h1 { color: #1f2937; font-size: 24px; }
-                    p { color: #6b7280; font-size: 16px; }
-                    a { color: #10b981; text-decoration: none; font-weight: bold; }
-                    a:hover { text-decoration: underline; }
-                </style>
-            </head>
-            <body>
-                <h1>無效的返回</h1>
-                <p>缺少平台訂單ID，無法處理您的支付請求。</p>
-                <p>點擊 <a href="https://magadha.weebly.com">這裡</a> 返回商店。</p>
-            </body>
-            </html>
-            '''
-
-        return '''
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>支付完成</title>
-            <style>
-                body { font-family: Arial, sans-serif; text-align: center; padding: 50px; background-color: #f9fafb; }
-                h1 { color: #1f2937; font-size: 24px; }
-                p { color: #6b7280; font-size: 16px; }
-                a { color: #10b981; text-decoration: none; font-weight: bold; }
-                a:hover { text-decoration: underline; }
-            </style>
-        </head>
-        <body>
-            <h1>支付完成！</h1>
-            <p>即將在 3 秒後自動返回商店...</p>
-            <p>如果未自動跳轉，請點擊 <a href="https://magadha.weebly.com">這裡</a> 返回商店。</p>
-            <script>
-                setTimeout(function() {
-                    window.location.href = "https://magadha.weebly.com";
-                }, 3000);
-            </script>
-        </body>
-        </html>
-        '''
-    except Exception as e:
-        import traceback
-        logger.error(f"返回錯誤: {str(e)}")
-        logger.error(f"堆棧跟踪: {traceback.format_exc()}")
-        return '''
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>伺服器錯誤</title>
-            <style>
-                body { font-family: Arial, sans-serif; text-align: center; padding: 50px; background-color: #f9fafb; }
-                h1 { color: #1f2937; font-size: 24px; }
-                p { color: #6b7280; font-size: 16px; }
-                a { color: #10b981; text-decoration: none; font-weight: bold; }
-                a:hover { text-decoration: underline; }
-            </style>
-        </head>
-        <body>
-            <h1>伺服器錯誤</h1>
-            <p>很抱歉，伺服器發生錯誤。請稍後再試，或聯繫客服。</p>
-            <p>點擊 <a href="https://magadha.weebly.com">這裡</a> 返回商店。</p>
-        </body>
-        </html>
-        '''
-
-if __name__ == "__main__":
-    port = int(os.getenv("PORT", 8001))
-    app.run(host="0.0.0.0", port=port)
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import orjson
+import time
+import os
+import logging
+import atexit
+import threading
+from collections import deque
+from flask import Flask, request, Response, abort
+from werkzeug.exceptions import HTTPException
+from flask_cors import CORS
+from dotenv import load_dotenv
+from payment_core import (
+    build_entry_payload,
+    generate_signature,
+    missing_required_fields,
+    new_platform_order_id,
+)
+
+load_dotenv()
+
+# 設置日誌，僅輸出到終端（Render.com 會自動收集日誌）
+logging.basicConfig(
+    level=logging.INFO,
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+CORS(app, resources={r"/*": {"origins": "https://magadha.weebly.com"}})
+
+# 使用環境變數儲存敏感資訊
+JKO_PAY_STORE_ID = os.getenv("JKO_PAY_STORE_ID")
+JKO_PAY_API_KEY = os.getenv("JKO_PAY_API_KEY")
+JKO_PAY_SECRET_KEY = os.getenv("JKO_PAY_SECRET_KEY")
+JKO_PAY_ENTRY_URL = os.getenv("JKO_PAY_ENTRY_URL", "https://uat-onlinepay.jkopay.app/platform/entry")
+JKO_PAY_INQUIRY_URL = os.getenv("JKO_PAY_INQUIRY_URL", "https://uat-onlinepay.jkopay.app/platform/inquiry")
+JKO_PAY_REFUND_URL = os.getenv("JKO_PAY_REFUND_URL", "https://uat-onlinepay.jkopay.app/platform/refund")
+BASE_URL = os.getenv("BASE_URL", "https://jkpay.onrender.com")
+GOOGLE_SCRIPT_URL = os.getenv("GOOGLE_SCRIPT_URL", "https://script.google.com/macros/s/AKfycbwju-slnDJ9RYSgWctfjQ7Yg0FOU4Ur6YFu5UWLlKVPsDuMQ3niQI--2b1T06fWBe7PDQ/exec")
+
+# 檢查必要的環境變數是否存在
+required_env_vars = ["JKO_PAY_STORE_ID", "JKO_PAY_API_KEY", "JKO_PAY_SECRET_KEY"]
+for var in required_env_vars:
+    if not os.getenv(var):
+        logger.error("缺少必要的環境變數: %s", var)
+        raise ValueError(f"缺少必要的環境變數: {var}")
+
+# 共用連線（Session）重用 TCP/TLS 連線，避免每筆訂單重新握手
+def _build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# 對街口改用 httpx 並啟用 HTTP/2：多筆併發的付款請求可以多工共用同一條
+# TLS 連線，免去 requests（HTTP/1.1）逐請求排隊與重新建線
+_jko_client = httpx.Client(
+    http2=True,
+    timeout=httpx.Timeout(10.0, connect=3.0),
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+    ),
+    headers={"API-KEY": JKO_PAY_API_KEY}
+)
+_gscript_session = _build_session()
+
+# Google Apps Script 常要 0.5~2 秒才回應，改到背景執行緒批次送出：
+# 大量回調湧入時多筆訂單共用一次往返，不拖慢回覆街口的 ACK。
+# deque 的 append/popleft 是原子操作，跨執行緒使用不需額外加鎖
+_GSCRIPT_BATCH_SIZE = 20
+_GSCRIPT_FLUSH_INTERVAL = 0.25  # 秒
+_pending_gscript = deque()
+
+def _flush_gscript_batch():
+    batch = []
+    while _pending_gscript and len(batch) < _GSCRIPT_BATCH_SIZE:
+        try:
+            batch.append(_pending_gscript.popleft())
+        except IndexError:
+            break
+    if not batch:
+        return
+    try:
+        response = _gscript_session.post(GOOGLE_SCRIPT_URL, json={"orders": batch}, timeout=10)
+        logger.debug("Google Apps Script 回應（%d 筆）: %s", len(batch), response.text)
+    except Exception as e:
+        logger.error("發送訂單到 Google Apps Script 失敗（%d 筆）: %s", len(batch), str(e))
+
+def _gscript_flusher():
+    while True:
+        time.sleep(_GSCRIPT_FLUSH_INTERVAL)
+        _flush_gscript_batch()
+
+threading.Thread(target=_gscript_flusher, daemon=True, name="gscript-flusher").start()
+
+@atexit.register
+def _flush_gscript_on_shutdown():
+    # 關機前把還沒送出的訂單清空，避免遺漏
+    while _pending_gscript:
+        _flush_gscript_batch()
+
+# 使用內存儲存訂單（Render.com 文件系統是臨時的），以 platform_order_id 為鍵，查找/刪除皆 O(1)。
+# 注意：這是單一進程內的 dict，gunicorn 必須維持 -w 1（見 Procfile）——
+# 多個 worker 各有一份 orders，街口的回調會落在沒看過該訂單的進程而 404；
+# 要開多 worker 前得先把訂單改存共享儲存（如 Redis）
+orders = {}
+
+# 街口請求中固定不變的部分，模組載入時建好；動態欄位以佔位值保留，
+# 確保合併後的鍵順序與簽名用的 JSON 順序一致（與 PHP 一致）。
+# Python 3.7+ 字典保留插入順序，因此簽名前不需要再重排一次欄位 ——
+# 此模板的鍵順序即為簽名的標準欄位順序，調整時務必與街口文件核對
+_DATA_TEMPLATE = {
+    "store_id": JKO_PAY_STORE_ID,
+    "platform_order_id": None,
+    "currency": "TWD",
+    "total_price": None,
+    "final_price": None,
+    "unredeem": 0,  # 固定為 0，根據街口要求
+    "result_url": f"{BASE_URL}/result_url",
+    "result_display_url": f"{BASE_URL}/result_display_url"
+}
+
+_JKO_HEADERS_BASE = {
+    "Content-Type": "application/json; charset=utf-8",
+    "API-KEY": JKO_PAY_API_KEY
+}
+
+# /result_display_url 的三個靜態頁面，模組載入時就編成 bytes，回應時近似 memcpy
+_HTML_SUCCESS = '''
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>支付完成</title>
+    <style>
+        body { font-family: Arial, sans-serif; text-align: center; padding: 50px; background-color: #f9fafb; }
+        h1 { color: #1f2937; font-size: 24px; }
+        p { color: #6b7280; font-size: 16px; }
+        a { color: #10b981; text-decoration: none; font-weight: bold; }
+        a:hover { text-decoration: underline; }
+    </style>
+</head>
+<body>
+    <h1>支付完成！</h1>
+    <p>即將在 3 秒後自動返回商店...</p>
+    <p>如果未自動跳轉，請點擊 <a href="https://magadha.weebly.com">這裡</a> 返回商店。</p>
+    <script>
+        setTimeout(function() {
+            window.location.href = "https://magadha.weebly.com";
+        }, 3000);
+    </script>
+</body>
+</html>
+'''.encode("utf-8")
+
+_HTML_INVALID = '''
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>無效的返回</title>
+    <style>
+        body { font-family: Arial, sans-serif; text-align: center; padding: 50px; background-color: #f9fafb; }
+        h1 { color: #1f2937; font-size: 24px; }
+        p { color: #6b7280; font-size: 16px; }
+        a { color: #10b981; text-decoration: none; font-weight: bold; }
+        a:hover { text-decoration: underline; }
+    </style>
+</head>
+<body>
+    <h1>無效的返回</h1>
+    <p>缺少平台訂單ID，無法處理您的支付請求。</p>
+    <p>點擊 <a href="https://magadha.weebly.com">這裡</a> 返回商店。</p>
+</body>
+</html>
+'''.encode("utf-8")
+
+_HTML_ERROR = '''
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>伺服器錯誤</title>
+    <style>
+        body { font-family: Arial, sans-serif; text-align: center; padding: 50px; background-color: #f9fafb; }
+        h1 { color: #1f2937; font-size: 24px; }
+        p { color: #6b7280; font-size: 16px; }
+        a { color: #10b981; text-decoration: none; font-weight: bold; }
+        a:hover { text-decoration: underline; }
+    </style>
+</head>
+<body>
+    <h1>伺服器錯誤</h1>
+    <p>很抱歉，伺服器發生錯誤。請稍後再試，或聯繫客服。</p>
+    <p>點擊 <a href="https://magadha.weebly.com">這裡</a> 返回商店。</p>
+</body>
+</html>
+'''.encode("utf-8")
+
+def _html_response(body, status=200):
+    # 頁面與訂單無關，允許瀏覽器/CDN 短暫快取
+    return Response(body, status=status, mimetype="text/html", headers={"Cache-Control": "public, max-age=300"})
+
+# 三種結果頁完全無狀態，Response 物件在模組載入時建好直接重用，
+# 回應時不再經過 Response.__init__ 與 headers dict 的組裝
+_RESPONSE_SUCCESS = _html_response(_HTML_SUCCESS)
+_RESPONSE_INVALID = _html_response(_HTML_INVALID, 400)
+_RESPONSE_ERROR = _html_response(_HTML_ERROR, 500)
+
+# JSON 回應統一走 orjson（Rust/SIMD 編碼器，直接輸出 UTF-8 bytes）
+def _json_response(payload, status=200):
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+# 請求主體也走 orjson 解析（直接吃 UTF-8 bytes，免去 bytes→str 解碼），
+# 並限制大小，避免超大主體耗盡記憶體
+_MAX_JSON_BODY = 16384
+
+def _parse_json_body():
+    raw = request.get_data(cache=False, parse_form_data=False)
+    if len(raw) > _MAX_JSON_BODY:
+        abort(413)
+    try:
+        body = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None
+    return body if isinstance(body, dict) else None
+
+@app.route("/")
+def home():
+    logger.info("摩揭陀貓舍街口支付伺服器已啟動！（測試環境）")
+    return "摩揭陀貓子街口支付伺服器已啟動！（測試環境）"
+
+@app.route("/generate_payment", methods=["POST"])
+def generate_payment():
+    try:
+        order_data = _parse_json_body()
+        if order_data is None:
+            logger.error("無效的 JSON 請求主體")
+            return _json_response({"error": "無效的 JSON 請求主體"}, 400)
+        logger.debug("收到訂單資料: %s", order_data)
+
+        # 根據運送方式動態設置必填字段
+        missing_fields = missing_required_fields(order_data, order_data.get("shipping"))
+        if missing_fields:
+            logger.error("缺少必要的字段: %s", missing_fields)
+            return _json_response({"error": f"缺少必要的字段: {missing_fields}"}, 400)
+
+        total_amount = int(order_data["totalAmount"])
+        quantity = int(order_data["quantity"])
+        payment_method = order_data["payment"]
+
+        # 輸入驗證
+        if total_amount <= 0 or quantity <= 0:
+            logger.error("totalAmount 和 quantity 必須為正整數")
+            return _json_response({"error": "totalAmount 和 quantity 必須為正整數"}, 400)
+        if total_amount > 1_000_000:
+            logger.error("totalAmount 超過允許的最大值")
+            return _json_response({"error": "totalAmount 超過允許的最大值"}, 400)
+
+        if payment_method != "jkopay":
+            logger.error("不支持的付款方式: %s", payment_method)
+            return _json_response({"error": f"不支持的付款方式: {payment_method}"}, 400)
+
+        # 街口支付邏輯（純計算部分在 payment_core，可經 mypyc 編譯）
+        platform_order_id = new_platform_order_id()
+        data = build_entry_payload(_DATA_TEMPLATE, platform_order_id, total_amount)
+
+        # 計算簽名（與 PHP 一致）；簽名與實際送出的 bytes 完全相同，避免重新序列化造成簽章不符
+        payload_bytes = orjson.dumps(data)
+        signature = generate_signature(payload_bytes, JKO_PAY_SECRET_KEY)
+        logger.debug("生成的簽名: %s", signature)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("發送的請求數據: %s", payload_bytes.decode("utf-8"))
+            logger.debug("請求頭: %s", {**_JKO_HEADERS_BASE, "DIGEST": signature})
+
+        headers = {**_JKO_HEADERS_BASE, "DIGEST": signature}
+
+        response = _jko_client.post(JKO_PAY_ENTRY_URL, headers=headers, content=payload_bytes)
+        logger.debug("發送街口支付請求 - 狀態碼: %s, 回應: %s", response.status_code, response.text)
+
+        if response.status_code == 200:
+            try:
+                result = response.json()
+            except ValueError as e:
+                logger.error("無法解析街口支付回應: %s", response.text)
+                return _json_response({"error": "無法解析街口支付回應"}, 500)
+
+            if result.get("result") == "000":
+                payment_url = result["result_object"]["payment_url"]
+                logger.info("街口支付連結生成成功，平台訂單ID: %s, 支付URL: %s", platform_order_id, payment_url)
+
+                # 保存訂單到內存
+                order_to_save = {
+                    **order_data,
+                    "platform_order_id": platform_order_id,
+                    "payment_url": payment_url
+                }
+                orders[platform_order_id] = order_to_save
+                logger.debug("訂單已保存: %s", order_to_save)
+
+                return _json_response({"paymentUrl": payment_url})
+            else:
+                logger.error("街口支付錯誤: %s", result)
+                return _json_response({"error": f"街口支付錯誤: {result.get('message', '未知錯誤')}"}, 500)
+        return _json_response({"error": f"無法生成街口支付連結，狀態碼: {response.status_code}"}, 500)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        logger.error("錯誤: %s", str(e))
+        logger.error("堆棧跟踪: %s", traceback.format_exc())
+        return _json_response({"error": f"伺服器錯誤: {str(e)}"}, 500)
+
+@app.route("/confirm_url", methods=["POST"])
+def confirm_url():
+    try:
+        logger.info("進入 /confirm_url 路由")
+        callback_data = _parse_json_body()
+        if callback_data is None:
+            logger.error("無效的 JSON 請求主體")
+            return _json_response({"valid": False}, 400)
+        logger.debug("收到街口支付確認回調: %s", callback_data)
+
+        platform_order_id = callback_data.get("platform_order_id")
+        if not platform_order_id:
+            logger.error("無效的確認回調，缺少平台訂單ID")
+            return _json_response({"valid": False}, 400)
+
+        # 從內存中查找訂單
+        order_data = orders.get(platform_order_id)
+        if not order_data:
+            logger.error("找不到對應訂單，平台訂單ID: %s", platform_order_id)
+            return _json_response({"valid": False}, 404)
+        logger.debug("找到匹配的訂單: %s", order_data)
+
+        return _json_response({"valid": True})
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        logger.error("確認錯誤: %s", str(e))
+        logger.error("堆棧跟踪: %s", traceback.format_exc())
+        return _json_response({"valid": False}, 500)
+
+@app.route("/result_url", methods=["POST"])
+def result_url():
+    try:
+        logger.info("進入 /result_url 路由")
+        callback_data = _parse_json_body()
+        if callback_data is None:
+            logger.error("無效的 JSON 請求主體")
+            return _json_response({"status": "error", "message": "無效的 JSON 請求主體"}, 400)
+        logger.debug("收到街口支付回調: %s", callback_data)
+
+        transaction = callback_data.get("transaction", {})
+        platform_order_id = transaction.get("platform_order_id")
+        status = transaction.get("status")
+        trade_no = transaction.get("tradeNo")
+
+        if not platform_order_id:
+            logger.error("無效的回調，缺少平台訂單ID")
+            return _json_response({"status": "error", "message": "缺少平台訂單ID"}, 400)
+
+        # 從內存中查找訂單
+        order_data = orders.get(platform_order_id)
+        if not order_data:
+            logger.error("找不到對應訂單，平台訂單ID: %s", platform_order_id)
+            return _json_response({"status": "error", "message": "訂單未找到"}, 404)
+        logger.debug("找到匹配的訂單: %s", order_data)
+
+        if status == 0:  # 交易成功
+            order_data["paymentMethod"] = "jkopay"
+            order_data["tradeNo"] = trade_no
+            logger.debug("排入 Google Apps Script 批次: %s", order_data)
+            _pending_gscript.append(dict(order_data))
+
+            # 支付成功後，移除已處理的訂單
+            orders.pop(platform_order_id, None)
+
+            return _json_response({"status": "success", "message": "支付確認成功"})
+        else:
+            logger.error("街口支付確認失敗，狀態碼: %s", status)
+            return _json_response({"status": "error", "message": "支付確認失敗"}, 400)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        logger.error("確認錯誤: %s", str(e))
+        logger.error("堆棧跟踪: %s", traceback.format_exc())
+        return _json_response({"status": "error", "message": "伺服器錯誤"}, 500)
+
+@app.route("/result_display_url", methods=["GET"])
+def result_display_url():
+    try:
+        logger.info("進入 /result_display_url 路由")
+        platform_order_id = request.args.get("platform_order_id")
+        if not platform_order_id:
+            logger.error("無效的返回，缺少平台訂單ID")
+            return _RESPONSE_INVALID
+
+        return _RESPONSE_SUCCESS
+    except Exception as e:
+        import traceback
+        logger.error("返回錯誤: %s", str(e))
+        logger.error("堆棧跟踪: %s", traceback.format_exc())
+        return _RESPONSE_ERROR
+
+if __name__ == "__main__":
+    # 僅供本地開發；正式環境請用 gunicorn gthread worker（見 Procfile），
+    # 避免單執行緒開發伺服器讓對街口/Apps Script 的外呼互相卡住
+    port = int(os.getenv("PORT", 8001))
+    app.run(host="0.0.0.0", port=port, threaded=True)
@@ -0,0 +1,54 @@
+# 付款產生流程的純計算邏輯（驗證、訂單編號、請求組裝、簽名），
+# 與 Flask / 網路 I/O 完全無關，獨立成模組後可用 mypyc 預先編譯成
+# C 擴充（mypyc payment_core.py），main 直接 import 編譯後的版本即可
+import logging
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hmac as chmac
+
+logger = logging.getLogger(__name__)
+
+# 必填字段（模組載入時建好，避免每筆請求重建列表）
+_REQUIRED_711 = frozenset(["totalAmount", "quantity", "name", "email", "phone", "shipping", "payment", "storeInfo", "address"])
+_REQUIRED_DEFAULT = frozenset(["totalAmount", "quantity", "name", "email", "phone", "shipping", "payment", "city", "district", "address"])
+
+# 每把密鑰只做一次 HMAC 金鑰排程（ipad/opad 壓縮），之後以 copy() 複製狀態，
+# 省掉每筆簽名重算常數 key padding 的兩次 SHA-256 壓縮
+_hmac_templates: Dict[str, Any] = {}
+
+def _hmac_template(secret_key: str) -> Any:
+    template = _hmac_templates.get(secret_key)
+    if template is None:
+        template = chmac.HMAC(secret_key.encode("utf-8"), hashes.SHA256())
+        _hmac_templates[secret_key] = template
+    return template
+
+# 簽名計算函數（與 PHP 一致，不排序，直接對送出的 JSON bytes 簽名）
+# HMAC-SHA256 走 cryptography 的 OpenSSL 後端，可利用 CPU 的 SHA 指令集加速
+def generate_signature(payload_bytes: bytes, secret_key: str) -> str:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("簽名用的 JSON 字符串: %s", payload_bytes.decode("utf-8"))
+    h = _hmac_template(secret_key).copy()
+    h.update(payload_bytes)
+    return h.finalize().hex()
+
+# 根據運送方式回傳缺少的必填字段（排序以確保錯誤訊息穩定）
+def missing_required_fields(order_data: Dict[str, Any], shipping: Optional[str]) -> List[str]:
+    required_fields = _REQUIRED_711 if shipping == "7-11" else _REQUIRED_DEFAULT
+    return sorted(field for field in required_fields if not order_data.get(field))
+
+# uuid4().hex 省掉連字號格式化，訂單編號也因此短 4 個字元
+def new_platform_order_id() -> str:
+    return f"ORDER_{uuid.uuid4().hex}_{int(time.time())}"
+
+# 合併模板時覆寫既有鍵，保留模板的鍵順序（即簽名的標準欄位順序）
+def build_entry_payload(template: Dict[str, Any], platform_order_id: str, total_amount: int) -> Dict[str, Any]:
+    return {
+        **template,
+        "platform_order_id": platform_order_id,
+        "total_price": total_amount,
+        "final_price": total_amount
+    }